@@ -13,20 +13,39 @@
 # limitations under the License. 
 
 import argparse
+import copy
 import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 from PIL import Image
 
 import cv2
 import torch
-import numpy as np
-from torchvision.utils import save_image
+from torchvision.utils import make_grid
 from tqdm import tqdm
 from omegaconf import OmegaConf
+from diffusers.models.attention_processor import AttnProcessor2_0
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+except ImportError:
+    # Older torch, fall back to torch.backends.cuda.sdp_kernel
+    SDPBackend = sdpa_kernel = None
 
-from resadapter.model_loader import load_resadapter
-from resadapter.utils import draw_text_on_images
+from resadapter.model_loader import load_resadapter, set_resadapter
+from resadapter.utils import (
+    CACHE_DIR,
+    canny_to_rgb,
+    copy_to_host_async,
+    draw_text_on_images,
+    load_canny,
+    load_image,
+    resize_image,
+    to_opencv_layout,
+    write_image,
+    )
 from resadapter.pipeline_loader import (
     load_controlnet_pipeline, 
     load_ip_adapter_pipeline, 
@@ -34,17 +53,66 @@ from resadapter.pipeline_loader import (
     load_text2image_lcm_lora_pipeline,
     )
 
+# Expandable segments avoid vram fragmentation across batch sizes and resolutions,
+# must be set before the first cuda allocation
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, required=True)
     args = parser.parse_args()
     return args
 
+def get_image_size(np_image, config):
+    if config.get("scale_ratio", None):
+        return int(np_image.shape[1]*config.scale_ratio), int(np_image.shape[0]*config.scale_ratio)
+    return config.get("width", 512), config.get("height", 512)
+
+def prepare_image(image_path, config, grayscale=False):
+    np_image = load_image(image_path, grayscale=grayscale)
+    return Image.fromarray(resize_image(np_image, get_image_size(np_image, config)))
+
+def prepare_controlnet_image(image_path, config, output_dir, writer):
+    np_source = load_image(image_path)
+    np_source = resize_image(np_source, get_image_size(np_source, config))
+    np_edges = load_canny(np_source, image_path, cache_dir=config.get("cache_dir", CACHE_DIR))
+    if config.get("save_conditions", None):
+        writer(np_edges, os.path.join(output_dir, f"condition_{Path(image_path).stem}.jpg"), params=[cv2.IMWRITE_JPEG_QUALITY, 85])
+    condition_image = Image.fromarray(canny_to_rgb(np_edges))
+    return Image.fromarray(np_source), condition_image
+
+def prepare_ip_adapter_images(image_path, *extra_paths, config):
+    # Extra images (ip-adapter image, mask) are resized to the source image size
+    np_source = load_image(image_path)
+    size = get_image_size(np_source, config)
+    images = [Image.fromarray(resize_image(np_source, size))]
+    for extra_path in extra_paths:
+        images.append(Image.fromarray(resize_image(load_image(extra_path), size)))
+    return images
+
+def get_embeds_kwargs(embeds, negative_embeds, batch_size):
+    # Both are encoded without classifier free guidance, encode_prompt then returns
+    # (embeds, None) for sd and (embeds, None, pooled_embeds, None) for sdxl pipelines
+    kwargs = {
+        "prompt_embeds": embeds[0],
+        "negative_prompt_embeds": negative_embeds[0].expand(batch_size, -1, -1),
+    }
+    if len(embeds) == 4:
+        kwargs["pooled_prompt_embeds"] = embeds[2]
+        kwargs["negative_pooled_prompt_embeds"] = negative_embeds[2].expand(batch_size, -1)
+    return kwargs
+
 @torch.no_grad()
 def main():
     args = parse_args()
     # #### 1. Get config ####
     config = OmegaConf.load(args.config)
+    executor = ThreadPoolExecutor(max_workers=4)
+    write_futures = []
+
+    def submit_write(*args, **kwargs):
+        # Futures are kept, so failed writes are raised at the end of main
+        write_futures.append(executor.submit(write_image, *args, **kwargs))
 
     time_str = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
     if config.experiment_name != "":
@@ -56,6 +124,7 @@ def main():
 
     # #### 2.Load pipeline and scheduler ####
     task = config.get("task", None)
+    sub_task = config.get("sub_task", None)
     if task == "t2i":
         pipeline = load_text2image_pipeline(config)
     elif task == "t2i_accelerate":
@@ -68,219 +137,223 @@ def main():
         raise NotImplementedError
     
     device = torch.device(f"cuda:{config.get('device', 0)}")
-    pipeline = pipeline.to(device)
+    dtypes = {"fp16": torch.float16, "bf16": torch.bfloat16}
+    if config.get("dtype", "fp16") not in dtypes:
+        raise ValueError(f"Unsupported dtype {config.dtype}, expected one of {list(dtypes)}")
+    dtype = dtypes[config.get("dtype", "fp16")]
+    pipeline = pipeline.to(device, dtype)
+
+    # Load res-adapter once, baseline inference switches it off instead of reloading
+    if config.get("res_adapter_model", "") != "":
+        pipeline, norm_state_dicts = load_resadapter(pipeline, config)
+        print(f"Load res-adapter from {config.res_adapter_model}")
+        set_resadapter(pipeline, config, norm_state_dicts, enable=True)
 
     if config.get("enable_xformers", None):
+        # Fallback for Volta/Turing GPUs without flash attention kernels
         print("Enable xformers successfully.")
         pipeline.enable_xformers_memory_efficient_attention()
+        attention_context = nullcontext
+    else:
+        # ip-adapter has its own attention processors, which already use sdpa
+        if task != "ip_adapter":
+            pipeline.unet.set_attn_processor(AttnProcessor2_0())
+        print("Enable sdpa (flash attention) successfully.")
+        if SDPBackend is not None:
+            attention_context = partial(sdpa_kernel, [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+        else:
+            attention_context = partial(torch.backends.cuda.sdp_kernel, enable_flash=True, enable_mem_efficient=True, enable_math=False)
+
+    enable_compile = config.get("enable_compile", None)
+    if enable_compile:
+        print("Enable torch.compile successfully.")
+        pipeline.unet = torch.compile(pipeline.unet, mode="reduce-overhead", fullgraph=False)
+
+    # Latents are decoded on a side stream, which overlaps with the unet of the next chunk
+    vae_stream = torch.cuda.Stream(device=device)
+    vae = pipeline.vae
+    if vae.dtype == torch.float16 and vae.config.get("force_upcast", False) and hasattr(pipeline, "upcast_vae"):
+        # sdxl vae overflows in fp16, decode with a fp32 copy instead of upcasting the shared one
+        vae = copy.deepcopy(vae).to(torch.float32)
+    if config.get("enable_vae_tiling", None):
+        vae.enable_tiling()
+    if enable_compile and task == "t2i_accelerate":
+        vae.decode = torch.compile(vae.decode, mode="reduce-overhead", fullgraph=False)
 
     # #### 3.Get prompts and other condition ####
     p_prompts = config.get("prompts", [])
     n_prompt = config.get("n_prompt", "")
 
-    if task == "controlnet":
-        condition_images = []
-        source_images = []
-        for image_path in config.get("source_images", []):
-            source_image = Image.open(image_path)
-            if config.get("scale_ratio", None):
-                width, height = int(source_image.size[0]*config.scale_ratio), int(source_image.size[1]*config.scale_ratio)
-            else:
-                width, height = config.get("width", 512), config.get("height", 512)
-            source_image = source_image.resize((width, height))
-            source_images.append(source_image)
-            np_condition = np.array(source_image)
-            np_condition = cv2.Canny(np_condition, 100, 200)
-            np_condition = np_condition[:, :, None]
-            np_condition = np.concatenate([np_condition, np_condition, np_condition], axis=2)
-            condition_image = Image.fromarray(np_condition)
-            condition_image.save(os.path.join(output_dir, f"condition_{Path(image_path).stem}.jpg"))
-            condition_images.append(condition_image)
-
-    if task == "t2i_adapter":
-        condition_images = []
-        for condition_path in config.get("condition_images", []):
-            condition_image = Image.open(condition_path)
-            if config.get("scale_ratio", None):
-                width, height = int(condition_image.size[0]*config.scale_ratio), int(condition_image.size[1]*config.scale_ratio)
-            else:
-                width, height = config.get("width", 512), config.get("height", 512)
-            condition_image = condition_image.resize((width, height)).convert("L")
-            condition_images.append(condition_image)
-
-    if task == "ip_adapter":
-        sub_task = config.get("sub_task", None)
-        # Image Variation
-        if sub_task == "image_variation":
-            ip_adapter_images = []
-            for ip_image_path in config.get("ip_adapter_images", []):
-                ip_adpater_image = Image.open(ip_image_path)
-                if config.get("scale_ratio", None):
-                    width, height = int(ip_adpater_image.size[0]*config.scale_ratio), int(ip_adpater_image.size[1]*config.scale_ratio)
-                else:
-                    width, height = config.get("width", 512), config.get("height", 512)
-
-                ip_adpater_image = ip_adpater_image.resize((width, height))
-                ip_adapter_images.append(ip_adpater_image)
-
-        # Image to Image
-        elif sub_task == "image_to_image":
-            ip_adapter_images = []
-            source_images = []
-            for ip_image_path, image_path in zip(config.get("ip_adapter_images", []), config.get("source_images", [])):
-                source_image = Image.open(image_path)
-                if config.get("scale_ratio", None):
-                    width, height = int(source_image.size[0]*config.scale_ratio), int(source_image.size[1]*config.scale_ratio)
-                else:
-                    width, height = config.get("width", 512), config.get("height", 512)
-                source_image = source_image.resize((width, height))
-                source_images.append(source_image)
-
-                ip_adapter_image = Image.open(ip_image_path)
-                ip_adapter_image = ip_adapter_image.resize((width, height))
-                ip_adapter_images.append(ip_adapter_image)
-            
-        # Image Inpainting
-        elif sub_task == "inpaint":
-            source_images = []
-            mask_images = []
-            ip_adapter_images = []
-            
-            for ip_image_path, image_path, mask_path in zip(config.get("ip_adapter_images", []), config.get("source_images", []), config.get("mask_images", [])):
-                source_image = Image.open(image_path)
-                if config.get("scale_ratio", None):
-                    width, height = int(source_image.size[0]*config.scale_ratio), int(source_image.size[1]*config.scale_ratio)
-                else:
-                    width, height = config.get("width", 512), config.get("height", 512)
-                source_image = source_image.resize((width, height))
-                source_images.append(source_image)
+    # Decode and resize in threads, opencv releases the gil
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        if task == "controlnet":
+            results = list(pool.map(partial(prepare_controlnet_image, config=config, output_dir=output_dir, writer=submit_write), config.get("source_images", [])))
+            source_images = [source_image for source_image, _ in results]
+            condition_images = [condition_image for _, condition_image in results]
 
-                mask_image = Image.open(mask_path)
-                mask_image = mask_image.resize((width, height))
-                mask_images.append(mask_image)
+        if task == "t2i_adapter":
+            condition_images = list(pool.map(partial(prepare_image, config=config, grayscale=True), config.get("condition_images", [])))
 
-                ip_adapter_image = Image.open(ip_image_path)
-                ip_adapter_image = ip_adapter_image.resize((width, height))
-                ip_adapter_images.append(ip_adapter_image)
+        if task == "ip_adapter":
+            # Image Variation
+            if sub_task == "image_variation":
+                ip_adapter_images = list(pool.map(partial(prepare_image, config=config), config.get("ip_adapter_images", [])))
 
-        else:
-            raise NotImplementedError
+            # Image to Image
+            elif sub_task == "image_to_image":
+                results = list(pool.map(partial(prepare_ip_adapter_images, config=config), config.get("source_images", []), config.get("ip_adapter_images", [])))
+                source_images = [result[0] for result in results]
+                ip_adapter_images = [result[1] for result in results]
 
-    # #### 4.Inference pipeline ####
+            # Image Inpainting
+            elif sub_task == "inpaint":
+                results = list(pool.map(partial(prepare_ip_adapter_images, config=config), config.get("source_images", []), config.get("ip_adapter_images", []), config.get("mask_images", [])))
+                source_images = [result[0] for result in results]
+                ip_adapter_images = [result[1] for result in results]
+                mask_images = [result[2] for result in results]
 
-    if config.get("seed", None):
-        generator = torch.Generator(device=device).manual_seed(config.seed)
-    else:
-        generator = None
+            else:
+                raise NotImplementedError
+
+    # #### 4.Inference pipeline ####
 
     if config.get("res_adapter_model", "") == "":
         enable_compare = False
     else:
         enable_compare = config.enable_compare
 
-    if enable_compare:
-        # Inference baseline
-        original_images = []
-        for i, prompt in tqdm(enumerate(p_prompts), total=len(p_prompts), desc="[Baselines]: "):
-            if task == "t2i" or task == "t2i_accelerate":
-                kwargs = {}
-            if task == "controlnet":
-                if sub_task == "text_to_image":
-                    kwargs = {"image": condition_images[i]}
-                if sub_task == "image_to_image":
-                    kwargs = {"control_image": condition_images[i], "image": source_images[i]}
-            if task == "t2i_adapter":
-                kwargs = {"image": condition_images[i]}
-            if task == "ip_adapter":
-                if sub_task == "image_variation":
-                    kwargs = {"ip_adapter_image": ip_adapter_images[i]}
-                if sub_task == "image_to_image":
-                    kwargs = {"image": source_images[i], "ip_adapter_image": ip_adapter_images[i], "strength": 0.6}
-                if sub_task == "inpaint":
-                    kwargs = {"image": source_images[i], "mask_image": mask_images[i], "ip_adapter_image": ip_adapter_images[i], "strength": 0.5}
-            
-            images = pipeline(
-                prompt=prompt,
+    # Prompts are batched into one pipeline call, chunked by max_batch to bound vram.
+    # ip-adapter treats a list of images as one image per adapter, scale_ratio gives a
+    # different size per source image, and controlnet img2img repeats the source latents
+    # as [A, B, A, B] while prompts and control images are repeated as [A, A, B, B], so
+    # they are run one prompt at a time.
+    if task == "ip_adapter" or config.get("scale_ratio", None) or (task == "controlnet" and sub_task == "image_to_image"):
+        max_batch = 1
+    else:
+        max_batch = config.get("max_batch", 8)
+    num_images_per_prompt = config.get("num_images_per_prompt", 2)
+
+    # Prompts are encoded up front, the negative prompt only once. res-adapter lora only
+    # touches the unet, so both passes share the embeddings
+    negative_embeds = pipeline.encode_prompt(
+        prompt=n_prompt, device=device, num_images_per_prompt=1, do_classifier_free_guidance=False,
+    )
+
+    # Pipeline kwargs per chunk of prompts, built once and shared by both passes
+    chunks = []
+    for start in range(0, len(p_prompts), max_batch):
+        end = min(start + max_batch, len(p_prompts))
+        embeds = pipeline.encode_prompt(
+            prompt=p_prompts[start:end], device=device, num_images_per_prompt=1, do_classifier_free_guidance=False,
+        )
+        embeds_kwargs = get_embeds_kwargs(embeds, negative_embeds, end - start)
+
+        kwargs = {}
+        if task == "controlnet":
+            if sub_task == "text_to_image":
+                kwargs = {"image": condition_images[start:end]}
+            if sub_task == "image_to_image":
+                kwargs = {"control_image": condition_images[start:end], "image": source_images[start:end]}
+        if task == "t2i_adapter":
+            kwargs = {"image": condition_images[start:end]}
+        if task == "ip_adapter":
+            if sub_task == "image_variation":
+                kwargs = {"ip_adapter_image": ip_adapter_images[start]}
+            if sub_task == "image_to_image":
+                kwargs = {"image": source_images[start], "ip_adapter_image": ip_adapter_images[start], "strength": 0.6}
+            if sub_task == "inpaint":
+                kwargs = {"image": source_images[start], "mask_image": mask_images[start], "ip_adapter_image": ip_adapter_images[start], "strength": 0.5}
+        chunks.append((start, end, {**embeds_kwargs, **kwargs}))
+
+    def run_inference(start, end, kwargs):
+        # One fresh generator per image, so the noise only depends on the prompt index and
+        # baseline and res-adapter passes start from the same latents
+        if config.get("seed", None):
+            generator = [
+                torch.Generator(device=device).manual_seed(config.seed + i * num_images_per_prompt + n)
+                for i in range(start, end) for n in range(num_images_per_prompt)
+            ]
+        else:
+            generator = None
+        # No autocast, pipeline.to already cast every component to dtype, and autocast would
+        # undo the fp32 vae encode diffusers runs for force_upcast vaes in img2img/inpaint
+        with attention_context():
+            latents = pipeline(
                 height=config.get("height", 512),
                 width=config.get("width", 512),
-                negative_prompt=n_prompt,
                 num_inference_steps=config.get("num_inference_steps", 25),
-                num_images_per_prompt=config.get("num_images_per_prompt", 2),
+                num_images_per_prompt=num_images_per_prompt,
                 generator=generator,
-                output_type="pt",
+                output_type="latent",
                 guidance_scale=config.get("guidance_scale", 7.5),
                 **kwargs,
             ).images
-            original_images.append(images)
 
-    # Load res-adapter
-    if config.get("res_adapter_model", "") != "":
-        pipeline = load_resadapter(pipeline, config)
-        print(f"Load res-adapter from {config.res_adapter_model}")
-        pipeline.set_adapters(["res_adapter"], adapter_weights=[config.get("res_adapter_alpha", 1.0)])
-    
-    if config.task == "t2i_accelerate":
-        pipeline.set_adapters(["res_adapter", "lcm_lora"], adapter_weights=[config.get("res_adapter_alpha", 1.0), config.get("lcm_lora_alpha", 1.0)])
+        latents.record_stream(vae_stream)
+        vae_stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(vae_stream):
+            images = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+            has_nsfw_concept = None
+            # run_safety_checker postprocesses to pil, a blocking copy to host, so with a
+            # safety checker the host waits for this decode and the next chunk's unet no
+            # longer overlaps it
+            if getattr(pipeline, "safety_checker", None) is not None:
+                images, has_nsfw_concept = pipeline.run_safety_checker(images, device, latents.dtype)
+            # Same as diffusers, images blanked by the safety checker stay black
+            if has_nsfw_concept is None:
+                do_denormalize = [True] * images.shape[0]
+            else:
+                do_denormalize = [not has_nsfw for has_nsfw in has_nsfw_concept]
+            images = pipeline.image_processor.postprocess(images, output_type="pt", do_denormalize=do_denormalize)
+            # Quantize on gpu, so only uint8 images are copied to host
+            images = images.clamp_(0, 1).mul_(255).add_(0.5).to(torch.uint8)
+        return images.split(num_images_per_prompt)
+
+    if enable_compare:
+        # Inference baseline
+        set_resadapter(pipeline, config, norm_state_dicts, enable=False)
+        original_images = []
+        for start, end, kwargs in tqdm(chunks, desc="[Baselines]: "):
+            original_images.extend(run_inference(start, end, kwargs))
+        set_resadapter(pipeline, config, norm_state_dicts, enable=True)
+        # Release activations cached by the baseline pass
+        torch.cuda.empty_cache()
 
     # Inference with res-adapter
     resadapter_images = []
-    for i, prompt in tqdm(enumerate(p_prompts), total=len(p_prompts), desc="[ResAdapter]: "):
-        if task == "t2i" or task == "t2i_accelerate":
-            kwargs = {}
-        if task == "controlnet":
-            if sub_task == "text_to_image":
-                kwargs = {"image": condition_images[i]}
-            if sub_task == "image_to_image":
-                kwargs = {"control_image": condition_images[i], "image": source_images[i]}
-        if task == "t2i_adapter":
-            kwargs = {"image": condition_images[i]}
-        if task == "ip_adapter":
-            if sub_task == "image_variation":
-                kwargs = {"ip_adapter_image": ip_adapter_images[i]}
-            if sub_task == "image_to_image":
-                kwargs = {"image": source_images[i], "ip_adapter_image": ip_adapter_images[i], "strength": 0.6}
-            if sub_task == "inpaint":
-                kwargs = {"image": source_images[i], "mask_image": mask_images[i], "ip_adapter_image": ip_adapter_images[i], "strength": 0.5}
-
-        images = pipeline(
-            prompt=prompt,
-            height=config.get("height", 512),
-            width=config.get("width", 512),
-            negative_prompt=n_prompt,
-            num_inference_steps=config.get("num_inference_steps", 25),
-            num_images_per_prompt=config.get("num_images_per_prompt", 2),
-            generator=generator,
-            output_type="pt",
-            guidance_scale=config.get("guidance_scale", 7.5),
-            **kwargs,
-        ).images
-        resadapter_images.append(images)
-
-        # Save images
-        texts = ["ResAdapter", "Baseline"]
-        if enable_compare:
-            for j in range(config.get("num_images_per_prompt", 2)):
-                compare_image = torch.stack([resadapter_images[i][j], original_images[i][j]])
-                if config.get("draw_text", None):
-                    for k in range(len(texts)):
-                        compare_image[k] = draw_text_on_images(compare_image[k], texts[k])
-                
-                if config.get("split_images", None):
-                    for q in range(len(texts)):
-                        save_image(
-                            compare_image[q], os.path.join(output_dir, f"{prompt[:100]}_{j}_{texts[q]}.jpg"), normalize=True, value_range=(0, 1), nrow=2, padding=0,
-                        )
+    for start, end, kwargs in tqdm(chunks, desc="[ResAdapter]: "):
+        resadapter_images.extend(run_inference(start, end, kwargs))
+
+        # Save images on the vae stream, behind the decode of this chunk. Device to host
+        # copies go through pinned memory without blocking, the writer threads wait for
+        # the copy to finish before jpeg encoding
+        with torch.cuda.stream(vae_stream):
+            texts = ["ResAdapter", "Baseline"]
+            for i in range(start, end):
+                prompt = p_prompts[i]
+                if enable_compare:
+                    for j in range(num_images_per_prompt):
+                        compare_image = torch.stack([resadapter_images[i][j], original_images[i][j]])
+                        if config.get("draw_text", None):
+                            for k in range(len(texts)):
+                                draw_text_on_images(compare_image[k], texts[k])
+                    
+                        if config.get("split_images", None):
+                            host_image, event = copy_to_host_async(to_opencv_layout(compare_image))
+                            for q in range(len(texts)):
+                                submit_write(host_image[q], os.path.join(output_dir, f"{prompt[:100]}_{j}_{texts[q]}.jpg"), event)
+                        else:
+                            host_image, event = copy_to_host_async(to_opencv_layout(make_grid(compare_image, nrow=2, padding=0)))
+                            submit_write(host_image, os.path.join(output_dir, f"{prompt[:100]}_{j}.jpg"), event)
                 else:
-                    save_image(
-                        compare_image, os.path.join(output_dir, f"{prompt[:100]}_{j}.jpg"), normalize=True, value_range=(0, 1), nrow=2, padding=0,
-                    )
-        else:
-            compare_image = resadapter_images[i]
-            for m in range(config.get("num_images_per_prompt", 2)):
-                save_image(
-                    compare_image[m], os.path.join(output_dir, f"{prompt[:100]}_{m}.jpg"), normalize=True, value_range=(0, 1), nrow=2, padding=0,
-                )
-        print(f"Saving image to {os.path.join(output_dir, f'{prompt[:100]}.jpg')}")
+                    host_image, event = copy_to_host_async(to_opencv_layout(resadapter_images[i]))
+                    for m in range(num_images_per_prompt):
+                        submit_write(host_image[m], os.path.join(output_dir, f"{prompt[:100]}_{m}.jpg"), event)
+                print(f"Saving image to {os.path.join(output_dir, f'{prompt[:100]}.jpg')}")
+
+    for future in write_futures:
+        future.result()
+    executor.shutdown(wait=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -14,7 +14,18 @@
 
 import os
 
-from safetensors import safe_open
+from safetensors.torch import load_file
+
+# torch.compile wraps the unet, its state dict keys then carry an "_orig_mod." prefix
+def get_original_unet(pipeline):
+    return getattr(pipeline.unet, "_orig_mod", pipeline.unet)
+
+
+def load_norm_state_dict(pipeline, norm_state_dict):
+    m, u = get_original_unet(pipeline).load_state_dict(norm_state_dict, strict=False)
+    if u:
+        raise RuntimeError(f"Normalization weights do not match the unet, unexpected keys: {u}")
+
 
 # Load resadapter for scripts
 def load_resadapter(pipeline, config):
@@ -23,17 +34,43 @@ def load_resadapter(pipeline, config):
     LORA_WEIGHTS_NAME = "pytorch_lora_weights.safetensors"
 
     # Load resolution normalization
-    try:
-        norm_state_dict = {}
-        with safe_open(os.path.join(config.res_adapter_model, NORM_WEIGHTS_NAME), framework="pt", device="cpu") as f:
-            for key in f.keys():
-                norm_state_dict[key] = f.get_tensor(key)
-        m, u = pipeline.unet.load_state_dict(norm_state_dict, strict=False)
-        print(f"Load normalization safetensors from {os.path.join(config.res_adapter_model, NORM_WEIGHTS_NAME)}.")
-    except:
+    norm_state_dicts = {}
+    norm_weights_path = os.path.join(config.res_adapter_model, NORM_WEIGHTS_NAME)
+    if os.path.exists(norm_weights_path):
+        # Load straight onto the unet device, load_state_dict then casts in place
+        unet = get_original_unet(pipeline)
+        norm_state_dict = load_file(norm_weights_path, device=str(unet.device))
+        # Keep the original normalization, so that baseline can be restored without reloading
+        unet_state_dict = unet.state_dict()
+        norm_state_dicts["baseline"] = {key: unet_state_dict[key].clone() for key in norm_state_dict if key in unet_state_dict}
+        norm_state_dicts["res_adapter"] = norm_state_dict
+        load_norm_state_dict(pipeline, norm_state_dict)
+        print(f"Load normalization safetensors from {norm_weights_path}.")
+    else:
         print("There is no normalization safetensors, we can only load lora safetensors for resolution interpolation.")
     
     # Load resolution lora
     pipeline.load_lora_weights(os.path.join(config.res_adapter_model, LORA_WEIGHTS_NAME), adapter_name="res_adapter")
 
-    return pipeline
\ No newline at end of file
+    return pipeline, norm_state_dicts
+
+
+# Switch resadapter on or off in place, lcm-lora stays active for t2i_accelerate
+def set_resadapter(pipeline, config, norm_state_dicts, enable=True):
+    adapter_names, adapter_weights = [], []
+    if enable:
+        adapter_names.append("res_adapter")
+        adapter_weights.append(config.get("res_adapter_alpha", 1.0))
+    if config.task == "t2i_accelerate":
+        adapter_names.append("lcm_lora")
+        adapter_weights.append(config.get("lcm_lora_alpha", 1.0))
+
+    if adapter_names:
+        pipeline.enable_lora()
+        pipeline.set_adapters(adapter_names, adapter_weights=adapter_weights)
+    else:
+        pipeline.disable_lora()
+
+    norm_state_dict = norm_state_dicts.get("res_adapter" if enable else "baseline", None)
+    if norm_state_dict is not None:
+        load_norm_state_dict(pipeline, norm_state_dict)